@@ -15,9 +15,12 @@ import sys
 import warnings
 from argparse import ArgumentParser
 from argparse import Namespace
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import asynccontextmanager
+from contextvars import ContextVar
 from copy import copy
 from datetime import datetime
+from functools import lru_cache
 from glob import glob as glob_files
 from importlib import import_module
 from inspect import getsourcefile
@@ -25,13 +28,14 @@ from inspect import getsourcelines
 from inspect import iscoroutinefunction
 from stat import S_ISDIR
 from textwrap import dedent
-from threading import current_thread
+from time import time_ns
 from typing import Any
 from typing import AsyncGenerator
 from typing import Awaitable
 from typing import Callable
 from typing import Coroutine
 from typing import Dict
+from typing import Iterable
 from typing import Iterator
 from typing import List
 from typing import Optional
@@ -52,6 +56,13 @@ from yaml import Dumper
 from yaml import Loader
 from yaml import Node
 
+try:
+    from yaml import CSafeDumper as YamlDumper
+    from yaml import CSafeLoader as YamlSafeLoader
+except ImportError:  # pragma: no cover
+    from yaml import SafeDumper as YamlDumper
+    from yaml import SafeLoader as YamlSafeLoader
+
 __author__ = "Oren Ben-Kiki"
 __email__ = "oren@ben-kiki.org"
 __version__ = "0.6.2-dev.1"
@@ -147,9 +158,18 @@ def no_additional_complaints() -> None:
     warnings.simplefilter("ignore")
 
 
-def capture2re(capture: str) -> str:  # pylint: disable=too-many-statements
+def _asyncio_warnings() -> None:
+    asyncio_logger = logging.getLogger("asyncio")
+    if asyncio_logger.level != logging.WARNING:
+        asyncio_logger.setLevel(logging.WARNING)
+
+
+def capture2re(capture: str, *, named: bool = True) -> str:  # pylint: disable=too-many-statements
     """
     Translate a capture pattern to the equivalent ``re.Pattern``.
+
+    If ``named`` is ``False``, the captures are translated to non-capturing groups. This allows combining several
+    patterns into a single alternation even if they capture the same names.
     """
     index = 0
     size = len(capture)
@@ -224,9 +244,12 @@ def capture2re(capture: str) -> str:  # pylint: disable=too-many-statements
     def _append_regexp(name: str, regexp: str, prefix: str = "", suffix: str = "") -> None:
         nonlocal results
         results.append(prefix)
-        results.append("(?P<")
-        results.append(name)
-        results.append(">")
+        if named:
+            results.append("(?P<")
+            results.append(name)
+            results.append(">")
+        else:
+            results.append("(?:")
         results.append(regexp)
         results.append(")")
         results.append(suffix)
@@ -267,6 +290,9 @@ def capture2glob(capture: str) -> str:  # pylint: disable=too-many-statements
     """
     Translate a capture pattern to the equivalent ``glob`` pattern.
     """
+    if "{*" not in capture and "{{" not in capture and "}}" not in capture:
+        return str(capture)
+
     index = 0
     size = len(capture)
     results: List[str] = []
@@ -535,10 +561,11 @@ class AnnotatedStr(str):
 
 
 def _dump_str(dumper: Dumper, data: AnnotatedStr) -> Node:
-    return dumper.represent_scalar("tag:yaml.org,2002:str", data)
+    return dumper.represent_scalar("tag:yaml.org,2002:str", str(data))
 
 
 yaml.add_representer(AnnotatedStr, _dump_str)
+yaml.add_representer(AnnotatedStr, _dump_str, Dumper=YamlDumper)
 
 
 def copy_annotations(source: str, target: str) -> str:
@@ -585,6 +612,12 @@ def is_precious(string: str) -> bool:
     return isinstance(string, AnnotatedStr) and string.precious
 
 
+def _annotations(string: str) -> Tuple[bool, bool, bool, bool]:
+    if not isinstance(string, AnnotatedStr):
+        return (False, False, False, False)
+    return (string.optional, string.exists, string.phony, string.precious)
+
+
 # pylint: disable=missing-docstring,pointless-statement,multiple-statements,unused-argument
 
 
@@ -940,7 +973,7 @@ def glob_fmt(pattern: str, *templates: Strings) -> List[str]:
     results: List[str] = []
     for wildcards in glob_extract(pattern):
         for template in each_string(*templates):
-            results.append(copy_annotations(template, template.format(**wildcards)))
+            results.append(copy_annotations(template, template.format_map(wildcards)))
     return results
 
 
@@ -963,7 +996,7 @@ def str2enum(enum: type) -> Callable[[str], Any]:
     def _parse(string: str) -> Any:
         try:
             return enum[string.lower()]  # type: ignore
-        except BaseException:
+        except Exception:
             raise argparse.ArgumentTypeError(  # pylint: disable=raise-missing-from
                 "Expected one of: " + " ".join([value.name for value in enum])  # type: ignore
             )
@@ -1067,7 +1100,7 @@ class RangeParam:
 def _str2range(string: str, parser: Callable[[str], Union[int, float]], range: RangeParam) -> Union[int, float]:
     try:
         value = parser(string)
-    except BaseException:
+    except Exception:
         raise argparse.ArgumentTypeError(f"Expected {parser.__name__} value")  # pylint: disable=raise-missing-from
 
     if not range.is_valid(value):
@@ -1170,6 +1203,11 @@ def clean_path(path: str) -> str:
     return next_path
 
 
+_GLOB_MAGIC = re.compile(r"[*?\[]")
+
+_BACKREFERENCE = re.compile(r"\\[1-9]|\(\?P=")
+
+
 class Stat:
     """
     Cache stat calls for better performance.
@@ -1177,6 +1215,11 @@ class Stat:
 
     _cache: SortedDict
 
+    _thread_pool: Optional[ThreadPoolExecutor] = None
+
+    #: The minimal number of uncached files for which :py:func:`Stat.prefetch` is worth using parallel threads.
+    PREFETCH_THRESHOLD = 8
+
     @staticmethod
     def reset() -> None:
         """
@@ -1233,11 +1276,7 @@ class Stat:
         if result is not None and (not throw or not isinstance(result, BaseException)):
             return result
 
-        try:
-            result = os.stat(path)
-        except OSError as exception:
-            result = exception
-
+        result = Stat._try_os_stat(path)
         Stat._cache[path] = result
 
         if throw and isinstance(result, BaseException):
@@ -1246,12 +1285,63 @@ class Stat:
 
         return result
 
+    @staticmethod
+    def uncached(paths: List[str]) -> List[str]:
+        """
+        Return the (clean) paths of the files whose ``stat`` data is not cached.
+        """
+        return [path for path in map(clean_path, paths) if path not in Stat._cache]
+
+    @staticmethod
+    async def prefetch(paths: List[str]) -> None:
+        """
+        Cache the ``stat`` data of many files, performing the actual ``stat`` calls in parallel threads.
+
+        This allows the file system to overlap the latency of the calls, which matters for slow (e.g., network) file
+        systems. Only the ``stat`` calls run in the threads; the cache itself is only accessed in the calling thread.
+        Entries cached by other tasks while waiting for the calls take precedence over the prefetched data.
+        """
+        paths = Stat.uncached(paths)
+        loop = asyncio.get_running_loop()
+        executor = Stat._executor()
+        results = await asyncio.gather(*[loop.run_in_executor(executor, Stat._try_os_stat, path) for path in paths])
+        for path, result in zip(paths, results):
+            Stat._cache.setdefault(path, result)
+
+    @staticmethod
+    def prefetch_blocking(paths: List[str]) -> None:
+        """
+        Similar to :py:func:`Stat.prefetch`, but block until all the ``stat`` calls are done.
+
+        This allows overlapping the ``stat`` calls in synchronous code (e.g., :py:func:`dynamake.require`).
+        """
+        paths = Stat.uncached(paths)
+        if len(paths) < Stat.PREFETCH_THRESHOLD:
+            return
+        for path, result in zip(paths, Stat._executor().map(Stat._try_os_stat, paths)):
+            Stat._cache[path] = result
+
+    @staticmethod
+    def _executor() -> ThreadPoolExecutor:
+        if Stat._thread_pool is None:
+            Stat._thread_pool = ThreadPoolExecutor(thread_name_prefix="stat")
+        return Stat._thread_pool
+
+    @staticmethod
+    def _try_os_stat(path: str) -> Union[BaseException, os.stat_result]:
+        try:
+            return os.stat(path)
+        except OSError as exception:
+            return exception
+
     @staticmethod
     def glob(pattern: str) -> List[str]:
         """
         Fast glob through the cache.
 
         If the pattern is a file name we know about, we can just return the result without touching the file system.
+        If it is a file name we don't know about, we only need to ``stat`` it. A missing file is not cached, as it may
+        be an output that will be created by some action.
         """
 
         path = clean_path(pattern)
@@ -1260,6 +1350,12 @@ class Stat:
         if isinstance(result, BaseException):
             return []
 
+        if result is None and not _GLOB_MAGIC.search(pattern):
+            result = Stat._try_os_stat(path)
+            if isinstance(result, BaseException):
+                return []
+            Stat._cache[path] = result
+
         if result is None:
             paths = glob_files(pattern, recursive=True)
             if paths != [pattern]:
@@ -1275,13 +1371,22 @@ class Stat:
         Forget the cached ``stat`` data about a file. If it is a directory, also forget all the data about any files it
         contains.
         """
-        path = clean_path(path)
-        index = Stat._cache.bisect_left(path)
-        while index < len(Stat._cache):
-            index_path = Stat._cache.keys()[index]
-            if os.path.commonpath([path, index_path]) != path:
-                return
-            Stat._cache.popitem(index)
+        Stat.forget_many([path])
+
+    @staticmethod
+    def forget_many(paths: Iterable[str]) -> None:
+        """
+        Forget the cached ``stat`` data about several files. If any is a directory, also forget all the data about any
+        files it contains.
+        """
+        cache = Stat._cache
+        for path in paths:
+            path = clean_path(path)
+            cache.pop(path, None)
+            prefix = path + "/"
+            index = cache.bisect_left(prefix)
+            while index < len(cache) and cache.keys()[index].startswith(prefix):
+                cache.popitem(index)
 
     @staticmethod
     def rmdir(path: str) -> None:
@@ -1304,12 +1409,15 @@ class Stat:
             shutil.rmtree(path)
 
     @staticmethod
-    def touch(path: str) -> None:
+    def touch(path: str, mtime_ns: Optional[int] = None) -> None:
         """
-        Set the last modified time of a file (or a directory) to now.
+        Set the last modified time of a file (or a directory) to now, or to the specified ``mtime_ns``.
         """
         Stat.forget(path)
-        os.utime(path)
+        if mtime_ns is None:
+            os.utime(path)
+        else:
+            os.utime(path, ns=(mtime_ns, mtime_ns))
 
 
 #: The default module to load for steps and parameter definitions.
@@ -1321,8 +1429,17 @@ DEFAULT_CONFIG = "DynaMake.yaml"
 _is_test: bool = False
 
 
+_URL_SAFE = re.compile(r"[A-Za-z0-9_.~-]*")
+
+
+def _quote(string: str) -> str:
+    return string if _URL_SAFE.fullmatch(string) else quote_plus(string)
+
+
 def _dict_to_str(values: Dict[str, Any]) -> str:
-    return ",".join([f"{quote_plus(name)}={quote_plus(str(value))}" for name, value in sorted(values.items())])
+    if not values:
+        return ""
+    return ",".join([f"{_quote(name)}={_quote(str(value))}" for name, value in sorted(values.items())])
 
 
 def _location(function: Any) -> str:
@@ -1434,13 +1551,16 @@ class Parameter:  # pylint: disable=too-many-instance-attributes
         """
         Update the values based on loaded configuration files and/or explicit command line flags.
         """
-        if os.path.exists(DEFAULT_CONFIG):
+        try:
             Parameter.load_config(DEFAULT_CONFIG)
+        except FileNotFoundError:
+            pass
         for path in args.config or []:
             Parameter.load_config(path)
 
+        values = vars(args)
         for name, parameter in Parameter.by_name.items():
-            value = vars(args).get(name)
+            value = values.get(name)
             if value is not None:
                 if parameter.parser is None:
                     assert isinstance(value, bool)
@@ -1448,20 +1568,18 @@ class Parameter:  # pylint: disable=too-many-instance-attributes
                 else:
                     try:
                         parameter.value = parameter.parser(value)
-                    except BaseException:
+                    except Exception:
                         raise RuntimeError(  # pylint: disable=raise-missing-from
-                            f"Invalid value: {vars(args)[name]} for the parameter: {name}"
+                            f"Invalid value: {value} for the parameter: {name}"
                         )
 
-        name = sys.argv[0].split("/")[-1]
-
     @staticmethod
     def load_config(path: str) -> None:
         """
         Load a configuration file.
         """
         with open(path, "r") as file:
-            data = yaml.safe_load(file.read())
+            data = yaml.load(file.read(), Loader=YamlSafeLoader)
 
         if data is None:
             data = {}
@@ -1478,7 +1596,7 @@ class Parameter:  # pylint: disable=too-many-instance-attributes
                 assert parameter.parser is not None
                 try:
                     value = parameter.parser(value)
-                except BaseException:
+                except Exception:
                     raise RuntimeError(  # pylint: disable=raise-missing-from
                         f"Invalid value: {value} "
                         f"for the parameter: {name} "
@@ -1756,28 +1874,28 @@ class Resources:
         Return whether there are available resource to cover the requested
         amounts.
         """
-        for name, amount in amounts.items():
-            if amount > Resources.available[name]:
-                return False
-        return True
+        available = Resources.available
+        return all(amount <= available[name] for name, amount in amounts.items())
 
     @staticmethod
     def grab(amounts: Dict[str, int]) -> None:
         """
         Take ownership of some resource amounts.
         """
+        available = Resources.available
         for name, amount in amounts.items():
-            assert 0 <= amount <= Resources.available[name]
-            Resources.available[name] -= amount
+            assert 0 <= amount <= available[name]
+            available[name] -= amount
 
     @staticmethod
     def free(amounts: Dict[str, int]) -> None:
         """
         Release ownership of some resource amounts.
         """
+        available = Resources.available
         for name, amount in amounts.items():
-            assert 0 <= amount <= Resources.total[name] - Resources.available[name]
-            Resources.available[name] += amount
+            assert 0 <= amount <= Resources.total[name] - available[name]
+            available[name] += amount
 
 
 def resource_parameters(**default_amounts: int) -> None:
@@ -1839,6 +1957,17 @@ class Step:
     #: The step for building any output capture pattern.
     by_regexp: List[Tuple[Pattern, "Step"]]
 
+    #: A single regexp matching the outputs of all the steps (compiled on demand).
+    #:
+    #: This is ``None`` if it wasn't compiled yet, or if some output regexp contains a back-reference, which would be
+    #: renumbered by combining the regexps into a single alternation.
+    any_regexp: Optional[Pattern]
+
+    _is_any_regexp_safe: Optional[bool]
+
+    #: The (sorted) matches of the steps that may produce each path (computed on demand).
+    matches_by_path: Dict[str, List[Tuple[float, str, re.Match, "Step"]]]
+
     _is_finalized: bool
 
     @staticmethod
@@ -1848,8 +1977,30 @@ class Step:
         """
         Step.by_name = {}
         Step.by_regexp = []
+        Step.any_regexp = None
+        Step._is_any_regexp_safe = None
+        Step.matches_by_path = {}
         Step._is_finalized = False
 
+    @staticmethod
+    def may_produce(path: str) -> bool:
+        """
+        Whether any of the steps has an output pattern matching the path.
+        """
+        if Step._is_any_regexp_safe is None:
+            regexps = [
+                capture2re(capture, named=False)
+                for step in Step.by_name.values()  # pylint: disable=redefined-outer-name
+                for capture in step.output
+            ]
+            Step._is_any_regexp_safe = not any(_BACKREFERENCE.search(regexp) for regexp in regexps)
+            if Step._is_any_regexp_safe:
+                Step.any_regexp = re.compile("|".join(f"(?:{regexp})" for regexp in regexps))
+
+        if Step.any_regexp is None:
+            return any(regexp.fullmatch(path) for regexp, _ in Step.by_regexp)
+        return Step.any_regexp.fullmatch(path) is not None
+
     def __init__(
         self, function: Callable, output: Strings, priority: float  # pylint: disable=redefined-outer-name
     ) -> None:
@@ -1881,11 +2032,19 @@ class Step:
         for capture in each_string(output):
             capture = clean_path(capture)
             self.output.append(capture)
-            Step.by_regexp.append((capture2re(capture), self))
+            Step.by_regexp.append((re.compile(capture2re(capture)), self))
 
         if not self.output:
             raise RuntimeError(f"The step function: {_location(function)}" f" specifies no output")
 
+        #: The outputs sorted by name, for deterministic processing.
+        self.sorted_output: Tuple[str, ...] = tuple(sorted(self.output))
+
+        #: Optional copies of the sorted outputs, for collecting them after a failure.
+        self.optional_output: Tuple[str, ...] = tuple(
+            optional(copy_annotations(pattern, AnnotatedStr(pattern))) for pattern in self.sorted_output
+        )
+
         if self.name in Step.by_name:
             conflicting = Step.by_name[self.name].function
             raise RuntimeError(
@@ -1894,6 +2053,9 @@ class Step:
                 f" and: {_location(function)}"
             )
         Step.by_name[self.name] = self
+        Step.any_regexp = None
+        Step._is_any_regexp_safe = None
+        Step.matches_by_path = {}
 
 
 def above(name: str, by: float = 1) -> float:  # pylint: disable=invalid-name
@@ -1912,6 +2074,8 @@ class UpToDate:
     Data for each up-to-date target.
     """
 
+    __slots__ = ("producer", "mtime_ns")
+
     def __init__(self, producer: str, mtime_ns: int = 0) -> None:
         """
         Record a new up-to-date target.
@@ -1955,6 +2119,8 @@ class PersistentAction:
     of actions changes.
     """
 
+    __slots__ = ("command", "start", "end", "required", "previous")
+
     def __init__(self, previous: Optional["PersistentAction"] = None) -> None:
         #: The executed command.
         self.command: Optional[List[str]] = None
@@ -2001,26 +2167,30 @@ class PersistentAction:
         """
         Serialize for dumping to YAML.
         """
-        if self.previous:
-            data = self.previous.into_data()
-        else:
-            data = []
+        chain: List[PersistentAction] = []
+        action: Optional[PersistentAction] = self
+        while action is not None:
+            chain.append(action)
+            action = action.previous
 
-        datum: Dict[str, Any] = dict(
-            required={name: up_to_date.into_data() for name, up_to_date in self.required.items()}
-        )
+        data: List[Dict[str, Any]] = []
+        for action in reversed(chain):
+            datum: Dict[str, Any] = dict(
+                required={name: up_to_date.into_data() for name, up_to_date in action.required.items()}
+            )
 
-        if self.command is None:
-            assert self.start is None
-            assert self.end is None
-        else:
-            assert self.start is not None
-            assert self.end is not None
-            datum["command"] = self.command
-            datum["start"] = str(self.start)
-            datum["end"] = str(self.end)
+            if action.command is None:
+                assert action.start is None
+                assert action.end is None
+            else:
+                assert action.start is not None
+                assert action.end is not None
+                datum["command"] = action.command
+                datum["start"] = str(action.start)
+                datum["end"] = str(action.end)
+
+            data.append(datum)
 
-        data.append(datum)
         return data
 
     @staticmethod
@@ -2028,28 +2198,22 @@ class PersistentAction:
         """
         Construct the data from loaded YAML.
         """
-        if not data:
-            return [PersistentAction()]
+        actions: List[PersistentAction] = []
+        previous: Optional[PersistentAction] = None
 
-        datum = data[-1]
-        data = data[:-1]
+        for datum in data:
+            action = PersistentAction(previous)
+            action.required = {name: UpToDate.from_data(up_to_date) for name, up_to_date in datum["required"].items()}
 
-        if data:
-            actions = PersistentAction.from_data(data)
-            action = PersistentAction(actions[-1])
-            actions.append(action)
-        else:
-            action = PersistentAction()
-            actions = [action]
-
-        action.required = {name: UpToDate.from_data(up_to_date) for name, up_to_date in datum["required"].items()}
+            if "command" in datum:
+                action.command = datum["command"]
+                action.start = _datetime_from_str(datum["start"])
+                action.end = _datetime_from_str(datum["end"])
 
-        if "command" in datum:
-            action.command = datum["command"]
-            action.start = _datetime_from_str(datum["start"])
-            action.end = _datetime_from_str(datum["end"])
+            actions.append(action)
+            previous = action
 
-        return actions
+        return actions or [PersistentAction()]
 
 
 class LoggingFormatter(logging.Formatter):  # pragma: no cover
@@ -2144,8 +2308,9 @@ class RwLocks:
         lockers_status = RwLocks.lockers.get(name)
         if lockers_status is None:
             RwLocks.lockers[name] = lockers_status = (set(), set())
-        assert Invocation.current.log not in lockers_status[index]
-        lockers_status[index].add(Invocation.current.log)
+        log = Invocation.current().log
+        assert log not in lockers_status[index]
+        lockers_status[index].add(log)
 
     @staticmethod
     def become_nothing(index: int, name: str) -> None:
@@ -2159,8 +2324,9 @@ class RwLocks:
             RwLocks.log_status(name, am_locker=True)
 
         lockers_status = RwLocks.lockers[name]
-        assert Invocation.current.log in lockers_status[index]
-        lockers_status[index].remove(Invocation.current.log)
+        log = Invocation.current().log
+        assert log in lockers_status[index]
+        lockers_status[index].remove(log)
 
     @staticmethod
     def log_status(name: str, am_locker: bool = False) -> None:
@@ -2172,16 +2338,17 @@ class RwLocks:
         lockers = RwLocks.lockers.get(name)
         if lockers is not None:
             readers, modifiers = lockers
+            log = Invocation.current().log
 
             for reader in readers:
-                if reader == Invocation.current.log:
+                if reader == log:
                     assert not seen_locker
                     seen_locker = True
                 else:
                     Logger.debug(f"step: {reader} is reading data: {name}")
 
             for modifier in modifiers:
-                if modifier == Invocation.current.log:
+                if modifier == log:
                     assert not seen_locker
                     seen_locker = True
                 else:
@@ -2223,7 +2390,7 @@ class Logger:
         Logger._logger = logging.getLogger("dynamake")
         Logger._logger.setLevel("DEBUG")
         Logger.errors = False
-        logging.getLogger("asyncio").setLevel("WARN")
+        _asyncio_warnings()
 
     @staticmethod
     def setup(logger_name: str) -> None:
@@ -2232,7 +2399,7 @@ class Logger:
         """
         Logger._logger = logging.getLogger(logger_name)
         Logger.errors = False
-        logging.getLogger("asyncio").setLevel("WARN")
+        _asyncio_warnings()
 
         if not _is_test:
             # pragma: no cover
@@ -2259,6 +2426,9 @@ class Logger:
         if level >= logging.ERROR:
             Logger.errors = True
 
+        if not Logger._logger.isEnabledFor(level):
+            return
+
         if len(args) > 0:
             try:
                 message = message % args
@@ -2268,7 +2438,7 @@ class Logger:
                     f"mismatch between format: {message} " f"and args: {args}"
                 )
 
-        message = f"{Invocation.current.log} - {message}"
+        message = f"{Invocation.current().log} - {message}"
         Logger._logger.log(level, message)
 
     @staticmethod
@@ -2335,6 +2505,10 @@ logging.addLevelName(Logger.WHY, "WHY")
 logging.addLevelName(Logger.TRACE, "TRACE")
 
 
+#: The invocation whose code is currently running (each async task has its own).
+_current_invocation: "ContextVar[Invocation]" = ContextVar("current_invocation")
+
+
 class Invocation:  # pylint: disable=too-many-instance-attributes,too-many-public-methods
     """
     An active invocation of a build step.
@@ -2343,9 +2517,6 @@ class Invocation:  # pylint: disable=too-many-instance-attributes,too-many-publi
     #: The active invocations.
     active: Dict[str, "Invocation"]
 
-    #: The current invocation.
-    current: "Invocation"
-
     #: The top-level invocation.
     top: "Invocation"
 
@@ -2370,7 +2541,7 @@ class Invocation:  # pylint: disable=too-many-instance-attributes,too-many-publi
         Reset all the current state, for tests.
         """
         Invocation.active = {}
-        Invocation.current = None  # type: ignore
+        _current_invocation.set(None)  # type: ignore
         Invocation.top = Invocation(None, None)
         Invocation.top._become_current()  # pylint: disable=protected-access
         Invocation.up_to_date = {}
@@ -2379,6 +2550,13 @@ class Invocation:  # pylint: disable=too-many-instance-attributes,too-many-publi
         Invocation.actions_count = 0
         Invocation.skipped_count = 0
 
+    @staticmethod
+    def current() -> "Invocation":
+        """
+        Return the invocation whose code is currently running.
+        """
+        return _current_invocation.get()
+
     def __init__(  # pylint: disable=too-many-statements
         self,
         step: Optional[Step],  # pylint: disable=redefined-outer-name
@@ -2389,7 +2567,7 @@ class Invocation:  # pylint: disable=too-many-instance-attributes,too-many-publi
         Track the invocation of an async step.
         """
         #: The parent invocation, if any.
-        self.parent: Optional[Invocation] = Invocation.current
+        self.parent: Optional[Invocation] = Invocation.current()
 
         #: The step being invoked.
         self.step = step
@@ -2432,12 +2610,15 @@ class Invocation:  # pylint: disable=too-many-instance-attributes,too-many-publi
 
         self._verify_no_loop()
 
-        #: A condition variable to wait on for this invocation.
-        self.condition: Optional[asyncio.Condition] = None
+        #: An event to wait on for the completion of this invocation.
+        self.completed: Optional[asyncio.Event] = None
 
         #: The required input targets (phony or files) the invocations depends on.
         self.required: List[str] = []
 
+        #: The (annotated) required input targets by their path, for skipping repeated requirements.
+        self.required_by_path: Dict[str, str] = {}
+
         #: The required locked names (and whether to lock them for read or write).
         self.required_locks: Dict[str, bool] = {}
 
@@ -2456,7 +2637,10 @@ class Invocation:  # pylint: disable=too-many-instance-attributes,too-many-publi
         #: The expanded outputs for access by the step function.
         self.expanded_outputs: List[str] = []
 
-        #: The output files that existed prior to the invocation.
+        #: The expanded outputs, in the order of the step's sorted output patterns, for internal use.
+        self._formatted_outputs: Tuple[str, ...] = ()
+
+        #: The output files that existed prior to the invocation (sorted once they are all collected).
         self.initial_outputs: List[str] = []
 
         #: The phony outputs, if any.
@@ -2480,6 +2664,9 @@ class Invocation:  # pylint: disable=too-many-instance-attributes,too-many-publi
         #: The reason to abort this invocation, if any.
         self.exception: Optional[StepException] = None
 
+        #: The path of the persistent actions file (computed on first use).
+        self._persistent_actions_path: Optional[str] = None
+
         #: The old persistent actions (from the disk) for ensuring rebuild when actions change.
         self.old_persistent_actions: List[PersistentAction] = []
 
@@ -2504,6 +2691,7 @@ class Invocation:  # pylint: disable=too-many-instance-attributes,too-many-publi
 
     def _restart(self) -> None:
         self.required = []
+        self.required_by_path = {}
         self.newest_input_path = None
         self.newest_input_mtime_ns = 0
 
@@ -2523,36 +2711,48 @@ class Invocation:  # pylint: disable=too-many-instance-attributes,too-many-publi
         assert self.should_remove_stale_outputs == remove_stale_outputs.value
 
     def _verify_no_loop(self) -> None:
-        call_chain = [self.name]
         parent = self.parent
         while parent is not None:
-            call_chain.append(parent.name)
             if self.name == parent.name:
+                call_chain = [self.name]
+                caller = self.parent
+                while caller is not parent:
+                    assert caller is not None
+                    call_chain.append(caller.name)
+                    caller = caller.parent
+                call_chain.append(parent.name)
                 no_additional_complaints()
                 raise RuntimeError("step invokes itself: " + " -> ".join(reversed(call_chain)))
             parent = parent.parent
 
+    def persistent_actions_path(self) -> str:
+        """
+        The path of the disk file holding the persistent actions of the invocation.
+        """
+        global persistent_directory  # pylint: disable=invalid-name
+        if self._persistent_actions_path is None:
+            self._persistent_actions_path = os.path.join(persistent_directory.value, self.name + ".actions.yaml")
+        return self._persistent_actions_path
+
     def read_old_persistent_actions(self) -> None:
         """
         Read the old persistent data from the disk file.
 
         These describe the last successful build of the outputs.
         """
-        global persistent_directory  # pylint: disable=invalid-name
-        path = os.path.join(persistent_directory.value, self.name + ".actions.yaml")
-        if not os.path.exists(path):
-            Logger.why(f"Must run actions because missing the persistent actions: {path}")
-            self.must_run_action = True
-            return
-
+        path = self.persistent_actions_path()
         try:
             with open(path, "r") as file:
-                data = yaml.full_load(file.read())
+                data = yaml.load(file.read(), Loader=YamlSafeLoader)
             self.old_persistent_actions = PersistentAction.from_data(data["actions"])
             self.old_persistent_outputs = data["outputs"]
             Logger.debug(f"Read the persistent actions: {path}")
 
-        except BaseException:  # pylint: disable=broad-except
+        except FileNotFoundError:
+            Logger.why(f"Must run actions because missing the persistent actions: {path}")
+            self.must_run_action = True
+
+        except Exception:  # pylint: disable=broad-except
             Logger.warning(f"Must run actions " f"because read the invalid persistent actions: {path}")
             self.must_run_action = True
 
@@ -2560,11 +2760,12 @@ class Invocation:  # pylint: disable=too-many-instance-attributes,too-many-publi
         """
         Remove the persistent data from the disk in case the build failed.
         """
-        global persistent_directory  # pylint: disable=invalid-name
-        path = os.path.join(persistent_directory.value, self.name + ".actions.yaml")
-        if os.path.exists(path):
-            Logger.debug(f"Remove the persistent actions: {path}")
+        path = self.persistent_actions_path()
+        try:
             os.remove(path)
+            Logger.debug(f"Remove the persistent actions: {path}")
+        except FileNotFoundError:
+            pass
 
         if "/" not in self.name:
             return
@@ -2577,17 +2778,26 @@ class Invocation:  # pylint: disable=too-many-instance-attributes,too-many-publi
         """
         Write the new persistent data into the disk file.
 
-        This is only done on a successful build.
+        This is only done on a successful build. The data is written to a temporary file which then replaces the
+        actual one, so an interrupted build never leaves a partially written file behind.
         """
-        global persistent_directory  # pylint: disable=invalid-name
-        path = os.path.join(persistent_directory.value, self.name + ".actions.yaml")
+        path = self.persistent_actions_path()
         Logger.debug(f"Write the persistent actions: {path}")
 
-        os.makedirs(os.path.dirname(path), exist_ok=True)
+        data = dict(actions=self.new_persistent_actions[-1].into_data(), outputs=self.built_outputs)
+        text = yaml.dump(data, Dumper=YamlDumper)
+        temporary_path = path + ".tmp"
+
+        try:
+            file = open(temporary_path, "w")  # pylint: disable=consider-using-with
+        except FileNotFoundError:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            file = open(temporary_path, "w")  # pylint: disable=consider-using-with
 
-        with open(path, "w") as file:
-            data = dict(actions=self.new_persistent_actions[-1].into_data(), outputs=self.built_outputs)
-            file.write(yaml.dump(data))
+        with file:
+            file.write(text)
+
+        os.replace(temporary_path, path)
 
     def log_and_abort(self, *messages: str) -> None:
         """
@@ -2601,7 +2811,7 @@ class Invocation:  # pylint: disable=too-many-instance-attributes,too-many-publi
         """
         Abort the invocation for some reason.
         """
-        message = f"{Invocation.current.log} - {message}"
+        message = f"{Invocation.current().log} - {message}"
         self.exception = StepException(message)
         global failure_aborts_build  # pylint: disable=invalid-name
         global no_actions  # pylint: disable=invalid-name
@@ -2613,11 +2823,19 @@ class Invocation:  # pylint: disable=too-many-instance-attributes,too-many-publi
         """
         Require a file to be up-to-date before executing any actions or completing the current invocation.
         """
-        self._become_current()
         self.abort_due_to_other()
 
         path = clean_path(path)
 
+        previous = self.required_by_path.get(path)
+        if (
+            previous is not None
+            and _annotations(previous) == _annotations(path)
+            and (not self.new_persistent_actions or path in self.new_persistent_actions[-1].required)
+        ):
+            return
+        self.required_by_path[path] = path
+
         Logger.debug(f"Build the required: {path}")
 
         self.required.append(path)
@@ -2646,11 +2864,12 @@ class Invocation:  # pylint: disable=too-many-instance-attributes,too-many-publi
                 if is_optional(path):
                     Logger.debug(f"The optional required: {path} " f"does not exist and can't be built")
                 else:
+                    current = Invocation.current()
                     messages = [
                         f"Don't know how to make the target: {path}",
-                        f"invoked to produce the target: {Invocation.current.goal}",
+                        f"invoked to produce the target: {current.goal}",
                     ]
-                    parent = Invocation.current.parent
+                    parent = current.parent
                     while parent is not None:
                         if parent.goal is not None:
                             messages.append(f"required by the step: {parent.log}")
@@ -2683,16 +2902,16 @@ class Invocation:  # pylint: disable=too-many-instance-attributes,too-many-publi
         kwargs: Dict[str, Any] = {}
         producer: Optional[Step] = None
 
-        producers: List[Tuple[float, str, re.Match, Step]] = []
-
-        for (regexp, step) in Step.by_regexp:  # pylint: disable=redefined-outer-name
-            match = re.fullmatch(regexp, path)
-            if not match:
-                continue
-
-            producers.append((-step.priority, step.name, match, step))
-
-        producers = sorted(producers)
+        producers = Step.matches_by_path.get(path)
+        if producers is None:
+            producers = []
+            if Step.may_produce(path):
+                for (regexp, step) in Step.by_regexp:  # pylint: disable=redefined-outer-name
+                    match = regexp.fullmatch(path)
+                    if match:
+                        producers.append((-step.priority, step.name, match, step))
+                producers.sort()
+            Step.matches_by_path[path] = producers
 
         if Logger.isEnabledFor(logging.DEBUG) and len(producers) > 1:
             for _, _, _, candidate in producers:
@@ -2723,11 +2942,12 @@ class Invocation:  # pylint: disable=too-many-instance-attributes,too-many-publi
         """
         Actually run the invocation.
         """
+        self._become_current()
+
         active = Invocation.active.get(self.name)
         if active is not None:
             return await self.done(self.wait_for(active))
 
-        self._become_current()
         Logger.trace("Call")
 
         global rebuild_changed_actions  # pylint: disable=invalid-name
@@ -2752,9 +2972,6 @@ class Invocation:  # pylint: disable=too-many-instance-attributes,too-many-publi
         except StepException as exception:  # pylint: disable=broad-except
             self.exception = exception
 
-        finally:
-            self._become_current()
-
         if self.exception is None:
             assert not self.async_actions
             if self.new_persistent_actions:
@@ -2786,10 +3003,8 @@ class Invocation:  # pylint: disable=too-many-instance-attributes,too-many-publi
                 Logger.trace("Fail")
 
         del Invocation.active[self.name]
-        if self.condition is not None:
-            await self.done(self.condition.acquire())
-            self.condition.notify_all()
-            self.condition.release()
+        if self.completed is not None:
+            self.completed.set()
 
         global failure_aborts_build  # pylint: disable=invalid-name
         if self.exception is not None and failure_aborts_build.value:
@@ -2804,16 +3019,12 @@ class Invocation:  # pylint: disable=too-many-instance-attributes,too-many-publi
 
         This is used by other invocations that use this invocation's output(s) as their input(s).
         """
-        self._become_current()
-
         Logger.debug(f"Paused by waiting for: {active.log}")
 
-        if active.condition is None:
-            active.condition = asyncio.Condition()
+        if active.completed is None:
+            active.completed = asyncio.Event()
 
-        await self.done(active.condition.acquire())
-        await self.done(active.condition.wait())
-        active.condition.release()
+        await self.done(active.completed.wait())
 
         Logger.debug(f"Resumed by completion of: {active.log}")
 
@@ -2825,10 +3036,11 @@ class Invocation:  # pylint: disable=too-many-instance-attributes,too-many-publi
         actions need to be run to create or update them.
         """
         assert self.step is not None
+        self._formatted_outputs = tuple(fmt_capture(self.kwargs, pattern) for pattern in self.step.sorted_output)
+        self.expanded_outputs.extend(self._formatted_outputs)
+
         missing_outputs = []
-        for pattern in sorted(self.step.output):
-            formatted_pattern = fmt_capture(self.kwargs, pattern)
-            self.expanded_outputs.append(formatted_pattern)
+        for pattern, formatted_pattern in zip(self.step.sorted_output, self._formatted_outputs):
 
             if is_phony(formatted_pattern):
                 self.phony_outputs.append(formatted_pattern)
@@ -2849,20 +3061,19 @@ class Invocation:  # pylint: disable=too-many-instance-attributes,too-many-publi
             except NonOptionalException:
                 Logger.debug(f"Nonexistent required output(s): {pattern}")
                 self.missing_output = formatted_pattern
-                missing_outputs.append(capture2re(formatted_pattern))
+                missing_outputs.append(capture2re(formatted_pattern, named=False))
 
         if self.new_persistent_actions:
+            initial_outputs = set(self.initial_outputs)
+            missing_regexp: Optional[Pattern] = None
+            if missing_outputs:
+                missing_regexp = re.compile("|".join(f"(?:{regexp})" for regexp in missing_outputs))
+
             for path in self.old_persistent_outputs:
-                if path in self.initial_outputs:
+                if path in initial_outputs:
                     continue
 
-                was_reported = False
-                for regexp in missing_outputs:
-                    if re.fullmatch(regexp, path):
-                        was_reported = True
-                        break
-
-                if was_reported:
+                if missing_regexp is not None and missing_regexp.fullmatch(path):
                     continue
 
                 if Stat.exists(path):
@@ -2874,6 +3085,8 @@ class Invocation:  # pylint: disable=too-many-instance-attributes,too-many-publi
 
                 Stat.forget(path)
 
+        self.initial_outputs.sort()
+
         if (
             self.must_run_action
             or self.phony_outputs
@@ -2882,7 +3095,7 @@ class Invocation:  # pylint: disable=too-many-instance-attributes,too-many-publi
         ):
             return
 
-        for output_path in sorted(self.initial_outputs):
+        for output_path in self.initial_outputs:
             if is_exists(output_path):
                 continue
             output_mtime_ns = Stat.stat(output_path).st_mtime_ns
@@ -2904,15 +3117,27 @@ class Invocation:  # pylint: disable=too-many-instance-attributes,too-many-publi
         If successful, this marks all the outputs as up-to-date so that steps that depend on them will immediately
         proceed.
         """
-        self._become_current()
-
         missing_outputs = False
         assert self.step is not None
 
-        did_sleep = False
+        touch_mtime_ns: Optional[int] = None
+        is_debug = Logger.isEnabledFor(logging.DEBUG)
 
-        for pattern in sorted(self.step.output):  # pylint: disable=too-many-nested-blocks
-            formatted_pattern = fmt_capture(self.kwargs, pattern)
+        formatted_patterns = list(zip(self.step.sorted_output, self._formatted_outputs))
+
+        global touch_success_outputs  # pylint: disable=invalid-name
+        if not touch_success_outputs.value:
+            literal_paths: List[str] = []
+            for pattern, formatted_pattern in formatted_patterns:
+                if not is_phony(pattern):
+                    glob = capture2glob(formatted_pattern)
+                    if not _GLOB_MAGIC.search(glob):
+                        literal_paths.append(glob)
+            uncached_paths = Stat.uncached(literal_paths)
+            if len(uncached_paths) >= Stat.PREFETCH_THRESHOLD:
+                await self.done(Stat.prefetch(uncached_paths))
+
+        for pattern, formatted_pattern in formatted_patterns:  # pylint: disable=too-many-nested-blocks
             if is_phony(pattern):
                 Invocation.up_to_date[formatted_pattern] = UpToDate(self.name, self.newest_input_mtime_ns + 1)
                 continue
@@ -2922,21 +3147,25 @@ class Invocation:  # pylint: disable=too-many-instance-attributes,too-many-publi
                 if not paths:
                     Logger.debug(f"Did not make the optional output(s): {pattern}")
                 else:
-                    for path in paths:
-                        self.built_outputs.append(path)
+                    if not touch_success_outputs.value:
+                        uncached_paths = Stat.uncached(paths)
+                        if len(uncached_paths) >= Stat.PREFETCH_THRESHOLD:
+                            await self.done(Stat.prefetch(uncached_paths))
 
-                        global touch_success_outputs  # pylint: disable=invalid-name
+                    self.built_outputs.extend(paths)
+                    for path in paths:
                         if touch_success_outputs.value:
-                            if not did_sleep:
-                                await self.done(asyncio.sleep(1.0))
-                                did_sleep = True
+                            if touch_mtime_ns is None:
+                                touch_mtime_ns = max(time_ns(), self.newest_input_mtime_ns + 1)
                             Logger.file(f"Touch the output: {path}")
-                            Stat.touch(path)
+                            mtime_ns = await self.touch_output(path, touch_mtime_ns)
+                            touch_mtime_ns = max(touch_mtime_ns, mtime_ns)
+                        else:
+                            mtime_ns = Stat.stat(path).st_mtime_ns
 
-                        mtime_ns = Stat.stat(path).st_mtime_ns
                         Invocation.up_to_date[path] = UpToDate(self.name, mtime_ns)
 
-                        if Logger.isEnabledFor(logging.DEBUG):
+                        if is_debug:
                             if path == formatted_pattern:
                                 Logger.debug(f"Has the output: {path} " f"time: {_datetime_from_nanoseconds(mtime_ns)}")
                             else:
@@ -2946,7 +3175,6 @@ class Invocation:  # pylint: disable=too-many-instance-attributes,too-many-publi
                                 )
 
             except NonOptionalException:
-                self._become_current()
                 Logger.error(f"Missing the output(s): {pattern}")
                 missing_outputs = True
                 break
@@ -2954,35 +3182,103 @@ class Invocation:  # pylint: disable=too-many-instance-attributes,too-many-publi
         if missing_outputs:
             self.abort("Missing some output(s)")
 
+    async def touch_output(self, path: str, mtime_ns: int) -> int:
+        """
+        Touch an output so it will be newer than all the inputs, and return its actual modification time.
+
+        File systems may store modification times at a coarse granularity (even whole seconds). If this truncated the
+        requested time so the output is not newer than the newest input, try again at the next whole second, and as a
+        last resort wait for the clock to advance and touch it again. If even this fails (e.g., the inputs are in the
+        future), warn that the output will be considered stale by the next invocation.
+        """
+        Stat.touch(path, mtime_ns)
+        stored_mtime_ns = Stat.stat(path).st_mtime_ns
+        if stored_mtime_ns > self.newest_input_mtime_ns:
+            return stored_mtime_ns
+
+        next_second_mtime_ns = (self.newest_input_mtime_ns // 1_000_000_000 + 1) * 1_000_000_000
+        Stat.touch(path, next_second_mtime_ns)
+        stored_mtime_ns = Stat.stat(path).st_mtime_ns
+        if stored_mtime_ns > self.newest_input_mtime_ns:
+            return stored_mtime_ns
+
+        await self.done(asyncio.sleep(1.0))
+        Stat.touch(path)
+        stored_mtime_ns = Stat.stat(path).st_mtime_ns
+        if stored_mtime_ns <= self.newest_input_mtime_ns:
+            Logger.warning(
+                f"Failed to touch the output: {path} "
+                f"time: {_datetime_from_nanoseconds(stored_mtime_ns)} "
+                f"to be newer than the newest input "
+                f"time: {_datetime_from_nanoseconds(self.newest_input_mtime_ns)}"
+            )
+        return stored_mtime_ns
+
     def remove_stale_outputs(self) -> None:
         """
         Delete stale outputs before running a action.
 
         This is only done before running the first action of a step.
         """
-        for path in sorted(self.initial_outputs):
-            if self.should_remove_stale_outputs and not is_precious(path):
-                Logger.file(f"Remove the stale output: {path}")
-                Invocation.remove_output(path)
+        if not self.should_remove_stale_outputs:
+            Stat.forget_many(self.initial_outputs)
+            return
+
+        precious_paths: List[str] = []
+        directories: Set[str] = set()
+        for path in self.initial_outputs:
+            if is_precious(path):
+                precious_paths.append(path)
             else:
-                Stat.forget(path)
+                Logger.file(f"Remove the stale output: {path}")
+                Invocation.remove_output(path, directories)
+        Stat.forget_many(precious_paths)
+        Invocation.remove_emptied_directories(directories)
 
         self.should_remove_stale_outputs = False
 
     @staticmethod
-    def remove_output(path: str) -> None:
+    def remove_output(path: str, directories: Set[str]) -> None:
         """
-        Remove an output file, and possibly the directories that became empty as a result.
+        Remove an output file, and collect its directory into ``directories``, to be removed by
+        :py:func:`Invocation.remove_emptied_directories` if it became empty as a result.
         """
         try:
             Stat.remove(path)
-            global remove_empty_directories  # pylint: disable=invalid-name
-            while remove_empty_directories.value:
-                path = os.path.dirname(path)
-                Stat.rmdir(path)
-                Logger.file(f"Remove the empty directory: {path}")
         except OSError:
-            pass
+            return
+        directories.add(os.path.dirname(path))
+
+    @staticmethod
+    def remove_emptied_directories(directories: Set[str]) -> None:
+        """
+        Remove the directories (of removed outputs) that became empty, and their ancestors that became empty as a
+        result.
+
+        Deeper directories are tried first, and each directory is tried only once, regardless of how many outputs were
+        removed from it.
+        """
+        global remove_empty_directories  # pylint: disable=invalid-name
+        if not remove_empty_directories.value:
+            return
+
+        # Like ``os.removedirs``, stop at the top of the path instead of trying to remove ``""`` or ``/``.
+        by_depth: Dict[int, Set[str]] = {}
+        for directory in directories:
+            if directory and directory != "/":
+                by_depth.setdefault(directory.count("/"), set()).add(directory)
+
+        while by_depth:
+            depth = max(by_depth.keys())
+            for directory in sorted(by_depth.pop(depth)):
+                try:
+                    Stat.rmdir(directory)
+                except OSError:
+                    continue
+                Logger.file(f"Remove the empty directory: {directory}")
+                parent, name = os.path.split(directory)
+                if parent and name and parent != "/":
+                    by_depth.setdefault(parent.count("/"), set()).add(parent)
 
     def poison_all_outputs(self) -> None:
         """
@@ -2992,17 +3288,19 @@ class Invocation:  # pylint: disable=too-many-instance-attributes,too-many-publi
         """
         assert self.step is not None
 
-        for pattern in sorted(self.step.output):
-            formatted_pattern = fmt_capture(self.kwargs, optional(pattern))
+        directories: Set[str] = set()
+        for pattern in self.step.optional_output:
+            formatted_pattern = fmt_capture(self.kwargs, pattern)
             if is_phony(formatted_pattern):
                 Invocation.poisoned.add(formatted_pattern)
                 continue
-            for path in glob_paths(optional(formatted_pattern)):
+            for path in glob_paths(formatted_pattern):
                 Invocation.poisoned.add(path)
                 global remove_failed_outputs  # pylint: disable=invalid-name
                 if remove_failed_outputs.value and not is_precious(path):
                     Logger.file(f"Remove the failed output: {path}")
-                    Invocation.remove_output(path)
+                    Invocation.remove_output(path, directories)
+        Invocation.remove_emptied_directories(directories)
 
     def should_run_action(self) -> bool:  # pylint: disable=too-many-return-statements
         """
@@ -3086,38 +3384,47 @@ class Invocation:  # pylint: disable=too-many-instance-attributes,too-many-publi
         Check whether the required inputs of the new action are different from the required inputs of the last build
         action.
         """
-        for new_path in sorted(new_required.keys()):
-            if new_path not in old_required:
-                Logger.why(f"Must run actions because changed to require: {new_path}")
-                return True
+        new_paths = new_required.keys()
+        old_paths = old_required.keys()
 
-        for old_path in sorted(old_required.keys()):
-            if old_path not in new_required:
-                Logger.why(f"Must run actions because changed to not require: {old_path}")
-                return True
+        added_paths = new_paths - old_paths
+        if added_paths:
+            Logger.why(f"Must run actions because changed to require: {min(added_paths)}")
+            return True
 
-        for path in sorted(new_required.keys()):
-            old_up_to_date = old_required[path]
-            new_up_to_date = new_required[path]
-            if old_up_to_date.producer != new_up_to_date.producer:
-                Logger.why(
-                    f"Must run actions because the producer of the required: {path} "
-                    f'has changed from: {old_up_to_date.producer or "source file"} '
-                    f'into: {new_up_to_date.producer or "source file"}'
-                )
-                return True
-            if not is_exists(path) and old_up_to_date.mtime_ns != new_up_to_date.mtime_ns:
-                Logger.why(
-                    f"Must run actions "
-                    f"because the modification time of the required: {path} "
-                    f"has changed from: "
-                    f"{_datetime_from_nanoseconds(old_up_to_date.mtime_ns)} "
-                    f"into: "
-                    f"{_datetime_from_nanoseconds(new_up_to_date.mtime_ns)}"
-                )
-                return True
+        removed_paths = old_paths - new_paths
+        if removed_paths:
+            Logger.why(f"Must run actions because changed to not require: {min(removed_paths)}")
+            return True
 
-        return False
+        changed_paths = [
+            path
+            for path, new_up_to_date in new_required.items()
+            if old_required[path].producer != new_up_to_date.producer
+            or (not is_exists(path) and old_required[path].mtime_ns != new_up_to_date.mtime_ns)
+        ]
+        if not changed_paths:
+            return False
+
+        path = min(changed_paths)
+        old_up_to_date = old_required[path]
+        new_up_to_date = new_required[path]
+        if old_up_to_date.producer != new_up_to_date.producer:
+            Logger.why(
+                f"Must run actions because the producer of the required: {path} "
+                f'has changed from: {old_up_to_date.producer or "source file"} '
+                f'into: {new_up_to_date.producer or "source file"}'
+            )
+        else:
+            Logger.why(
+                f"Must run actions "
+                f"because the modification time of the required: {path} "
+                f"has changed from: "
+                f"{_datetime_from_nanoseconds(old_up_to_date.mtime_ns)} "
+                f"into: "
+                f"{_datetime_from_nanoseconds(new_up_to_date.mtime_ns)}"
+            )
+        return True
 
     async def run_action(  # pylint: disable=too-many-branches,too-many-statements,too-many-locals
         self,
@@ -3129,14 +3436,11 @@ class Invocation:  # pylint: disable=too-many-instance-attributes,too-many-publi
         """
         Spawn a action to actually create some files.
         """
-        self._become_current()
         self.abort_due_to_other()
 
         await self.done(self.sync())
 
         run_parts = []
-        persistent_parts = []
-        log_parts = []
         is_silent = None
         for part in each_string(*command):
             if is_silent is None:
@@ -3149,14 +3453,11 @@ class Invocation:  # pylint: disable=too-many-instance-attributes,too-many-publi
                     is_silent = False
 
             run_parts.append(part)
-            if not is_phony(part):
-                persistent_parts.append(part)
-
-            if kind != "shell":
-                part = copy_annotations(part, shlex.quote(part))
-            log_parts.append(part)
 
-        log_command = " ".join(log_parts)
+        if kind == "shell":
+            log_command = " ".join(run_parts)
+        else:
+            log_command = " ".join(map(shlex.quote, run_parts))
 
         if self.exception is not None:
             Logger.debug(f"Can't run: {log_command}")
@@ -3164,7 +3465,7 @@ class Invocation:  # pylint: disable=too-many-instance-attributes,too-many-publi
             raise self.exception
 
         if self.new_persistent_actions:
-            self.new_persistent_actions[-1].run_action(persistent_parts)
+            self.new_persistent_actions[-1].run_action(run_parts)
 
         if not self.should_run_action():
             global log_skipped_actions  # pylint: disable=invalid-name
@@ -3232,16 +3533,14 @@ class Invocation:  # pylint: disable=too-many-instance-attributes,too-many-publi
             if not no_actions.value:
                 Logger.trace(f"Success: {log_command}")
         finally:
-            self._become_current()
             if resources:
                 if Logger.isEnabledFor(logging.DEBUG):
                     Logger.debug("Free resources: " + _dict_to_str(resources))
-                Resources.free(resources)
+                async with Resources.condition:
+                    Resources.free(resources)
+                    Resources.condition.notify_all()
                 if Logger.isEnabledFor(logging.DEBUG):
                     Logger.debug("Available resources: " + _dict_to_str(Resources.available))
-                await self.done(Resources.condition.acquire())
-                Resources.condition.notify_all()
-                Resources.condition.release()
 
     async def _read_pipe(self, pipe: asyncio.StreamReader, level: int) -> None:
         while True:
@@ -3249,29 +3548,23 @@ class Invocation:  # pylint: disable=too-many-instance-attributes,too-many-publi
             if not line:
                 return
             message = line.decode("utf-8").rstrip("\n")
-            message = Invocation.current.log + " - " + message
+            message = Invocation.current().log + " - " + message
             Logger._logger.log(level, message)  # pylint: disable=protected-access
 
     async def _use_resources(self, amounts: Dict[str, int]) -> None:
-        self._become_current()
-
-        while True:
-            if Resources.have(amounts):
-                if Logger.isEnabledFor(logging.DEBUG):
-                    Logger.debug("Grab resources: " + _dict_to_str(amounts))
-                Resources.grab(amounts)
-                if Logger.isEnabledFor(logging.DEBUG):
-                    Logger.debug("Available resources: " + _dict_to_str(Resources.available))
-                return
-
+        if not Resources.have(amounts):
             if Logger.isEnabledFor(logging.DEBUG):
                 Logger.debug("Available resources: " + _dict_to_str(Resources.available))
                 Logger.debug("Paused by waiting for resources: " + _dict_to_str(amounts))
 
-            await self.done(Resources.condition.acquire())
-            await self.done(Resources.condition.wait())
+            async with Resources.condition:
+                await self.done(Resources.condition.wait_for(lambda: Resources.have(amounts)))
 
-            Resources.condition.release()
+        if Logger.isEnabledFor(logging.DEBUG):
+            Logger.debug("Grab resources: " + _dict_to_str(amounts))
+        Resources.grab(amounts)
+        if Logger.isEnabledFor(logging.DEBUG):
+            Logger.debug("Available resources: " + _dict_to_str(Resources.available))
 
     async def sync(self) -> Optional[BaseException]:  # pylint: disable=too-many-branches,too-many-statements
         """
@@ -3279,7 +3572,6 @@ class Invocation:  # pylint: disable=too-many-instance-attributes,too-many-publi
 
         This is implicitly called before running a action.
         """
-        self._become_current()
         self.abort_due_to_other()
 
         if self.async_actions:
@@ -3295,9 +3587,14 @@ class Invocation:  # pylint: disable=too-many-instance-attributes,too-many-publi
         Logger.debug("Synced")
 
         failed_inputs = False
+        stat_paths: List[str] = []
+        phony_paths = Invocation.phony
+        poisoned_paths = Invocation.poisoned
+        up_to_date = Invocation.up_to_date
         global no_actions  # pylint: disable=invalid-name
         for path in sorted(self.required):
-            if path in Invocation.poisoned or (not is_optional(path) and path not in Invocation.up_to_date):
+            is_up_to_date = path in up_to_date
+            if path in poisoned_paths or not (is_up_to_date or is_optional(path)):
                 if self.exception is None and not isinstance(self.exception, DryRunException):
                     level = logging.ERROR
                 else:
@@ -3306,11 +3603,11 @@ class Invocation:  # pylint: disable=too-many-instance-attributes,too-many-publi
                     Logger.log(level, f"Did not run actions for the required: {path}")
                 else:
                     Logger.log(level, f"The required: {path} has failed to build")
-                Invocation.poisoned.add(path)
+                poisoned_paths.add(path)
                 failed_inputs = True
                 continue
 
-            if path not in Invocation.up_to_date:
+            if not is_up_to_date:
                 assert is_optional(path)
                 continue
 
@@ -3319,8 +3616,16 @@ class Invocation:  # pylint: disable=too-many-instance-attributes,too-many-publi
             if is_exists(path):
                 continue
 
-            if path in Invocation.phony:
-                mtime_ns = Invocation.up_to_date[path].mtime_ns
+            stat_paths.append(path)
+
+        if not failed_inputs:
+            uncached_paths = Stat.uncached([path for path in stat_paths if path not in phony_paths])
+            if len(uncached_paths) >= Stat.PREFETCH_THRESHOLD:
+                await self.done(Stat.prefetch(uncached_paths))
+
+        for path in stat_paths:
+            if path in phony_paths:
+                mtime_ns = up_to_date[path].mtime_ns
             else:
                 mtime_ns = Stat.stat(path).st_mtime_ns
 
@@ -3361,9 +3666,7 @@ class Invocation:  # pylint: disable=too-many-instance-attributes,too-many-publi
         Await some non-DynaMake function.
         """
         self.abort_due_to_other()
-        result = await awaitable
-        self._become_current()
-        return result
+        return await awaitable
 
     def abort_due_to_other(self) -> None:
         """
@@ -3374,11 +3677,10 @@ class Invocation:  # pylint: disable=too-many-instance-attributes,too-many-publi
             self.abort("Aborting due to previous error")
 
     def _become_current(self) -> None:
-        Invocation.current = self
-        current_thread().name = self.stack
+        _current_invocation.set(self)
 
 
-_QUANTIZED_OF_NANOSECONDS: Dict[int, float] = {}
+_QUANTIZED_OF_NANOSECONDS: SortedDict = SortedDict()
 _NANOSECONDS_OF_QUANTIZED: Dict[str, int] = {}
 
 
@@ -3386,10 +3688,15 @@ def _datetime_from_str(string: str) -> datetime:
     return datetime.strptime(string, "%Y-%m-%d %H:%M:%S.%f")
 
 
+@lru_cache(maxsize=1024)
+def _format_second(seconds: int) -> str:
+    return datetime.fromtimestamp(seconds).strftime("%Y-%m-%d %H:%M:%S")
+
+
 def _datetime_from_nanoseconds(nanoseconds: int) -> str:
     if not _is_test:  # pylint: disable=protected-access
         # pragma: no cover
-        seconds = datetime.fromtimestamp(nanoseconds // 1_000_000_000).strftime("%Y-%m-%d %H:%M:%S")
+        seconds = _format_second(nanoseconds // 1_000_000_000)
         fraction = "%09d" % (nanoseconds % 1_000_000_000)  # pylint: disable=consider-using-f-string
         return seconds + "." + fraction
 
@@ -3397,20 +3704,15 @@ def _datetime_from_nanoseconds(nanoseconds: int) -> str:
     if quantized is not None:
         return str(quantized)
 
-    higher_nanoseconds = None
-    higher_quantized = None
-    lower_nanoseconds = None
+    index = _QUANTIZED_OF_NANOSECONDS.bisect_left(nanoseconds)
+
     lower_quantized = None
+    if index > 0:
+        _, lower_quantized = _QUANTIZED_OF_NANOSECONDS.peekitem(index - 1)
 
-    for old_nanoseconds, old_quantized in _QUANTIZED_OF_NANOSECONDS.items():
-        if old_nanoseconds < nanoseconds:
-            if lower_nanoseconds is None or lower_nanoseconds < old_nanoseconds:
-                lower_nanoseconds = old_nanoseconds
-                lower_quantized = old_quantized
-        if old_nanoseconds > nanoseconds:
-            if higher_nanoseconds is None or higher_nanoseconds < old_nanoseconds:
-                higher_nanoseconds = nanoseconds
-                higher_quantized = old_quantized
+    higher_quantized = None
+    if index < len(_QUANTIZED_OF_NANOSECONDS):
+        _, higher_quantized = _QUANTIZED_OF_NANOSECONDS.peekitem(index)
 
     if lower_quantized is None:
         if higher_quantized is None:
@@ -3428,16 +3730,22 @@ def _datetime_from_nanoseconds(nanoseconds: int) -> str:
     return str(quantized)
 
 
+@lru_cache(maxsize=8192)
+def _parse_second(string: str) -> int:
+    return int(datetime.fromisoformat(string).timestamp())
+
+
 def _nanoseconds_from_datetime_str(string: str) -> int:
     if _is_test:  # pylint: disable=protected-access
         return _NANOSECONDS_OF_QUANTIZED[string]
     seconds_string, nanoseconds_string = string.split(".")
 
-    seconds_datetime = _datetime_from_str(seconds_string + ".0")
-    seconds = int(seconds_datetime.timestamp())
+    seconds = _parse_second(seconds_string)
 
-    nanoseconds_string = (nanoseconds_string + 9 * "0")[:9]
-    nanoseconds = int(nanoseconds_string)
+    if len(nanoseconds_string) == 9:
+        nanoseconds = int(nanoseconds_string)
+    else:
+        nanoseconds = int((nanoseconds_string + 9 * "0")[:9])
 
     return seconds * 1_000_000_000 + nanoseconds
 
@@ -3445,8 +3753,10 @@ def _nanoseconds_from_datetime_str(string: str) -> int:
 def _reset_test_dates() -> None:
     global _QUANTIZED_OF_NANOSECONDS
     global _NANOSECONDS_OF_QUANTIZED
-    _QUANTIZED_OF_NANOSECONDS = {}
+    _QUANTIZED_OF_NANOSECONDS = SortedDict()
     _NANOSECONDS_OF_QUANTIZED = {}
+    _format_second.cache_clear()
+    _parse_second.cache_clear()
 
 
 def step(
@@ -3473,8 +3783,16 @@ def require(*paths: Strings) -> None:
 
     This queues an async build of the input file using the appropriate step, and immediately returns.
     """
-    for path in each_string(*paths):
-        Invocation.current.require(path)
+    current = Invocation.current()
+    required_paths = flatten(*paths)
+    if len(required_paths) >= Stat.PREFETCH_THRESHOLD:
+        source_paths = []
+        for path in map(clean_path, required_paths):
+            if path not in Invocation.up_to_date and path not in Invocation.poisoned and not Step.may_produce(path):
+                source_paths.append(path)
+        Stat.prefetch_blocking(source_paths)
+    for path in required_paths:
+        current.require(path)
 
 
 async def sync() -> Optional[BaseException]:
@@ -3483,7 +3801,7 @@ async def sync() -> Optional[BaseException]:
 
     This is invoked automatically before running actions.
     """
-    current = Invocation.current
+    current = Invocation.current()
     return await current.done(current.sync())
 
 
@@ -3502,16 +3820,18 @@ async def shell(*command: Strings, prefix: Optional[Strings] = None, **resources
     If ``prefix`` is specified, it is silently added to the command. By default this is the value of the
     :py:const:`default_shell_prefix` parameter.
     """
-    current = Invocation.current
+    current = Invocation.current()
     if prefix is None:
         global default_shell_prefix  # pylint: disable=invalid-name
         prefix = default_shell_prefix.value
+    prefix_parts = flatten(prefix)
 
     def _run_shell(parts: List[str]) -> Awaitable:
-        assert prefix is not None
+        if prefix_parts:
+            parts = prefix_parts + parts
         global shell_executable  # pylint: disable=invalid-name
         return asyncio.create_subprocess_shell(
-            " ".join(flatten(prefix, parts)),
+            parts[0] if len(parts) == 1 else " ".join(parts),
             executable=shell_executable.value,
             stdout=asyncio.subprocess.PIPE,
             stderr=asyncio.subprocess.PIPE,
@@ -3529,7 +3849,7 @@ async def spawn(*command: Strings, **resources: int) -> None:
 
     This first waits until all input files requested so far are ready.
     """
-    current = Invocation.current
+    current = Invocation.current()
 
     def _run_exec(parts: List[str]) -> Awaitable:
         return asyncio.create_subprocess_exec(*parts, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
@@ -3554,11 +3874,11 @@ def make(
     The optional ``adapter`` may perform additional adaptation of the execution environment based on the parsed
     command-line arguments before the actual function(s) are invoked.
     """
-    default_targets = flatten(default_targets)
+    default_paths = flatten(default_targets)
 
     _load_modules()
 
-    parser.add_argument("TARGET", nargs="*", help=f'The file or target to make (default: {" ".join(default_targets)})')
+    parser.add_argument("TARGET", nargs="*", help=f'The file or target to make (default: {" ".join(default_paths)})')
 
     parser.add_argument(
         "--module",
@@ -3591,7 +3911,7 @@ def make(
     if args.list_steps:
         _list_steps()
     else:
-        _build_targets([path for path in args.TARGET if path is not None] or flatten(default_targets))
+        _build_targets([path for path in args.TARGET if path is not None] or default_paths)
 
 
 def _load_modules() -> None:
@@ -3608,10 +3928,11 @@ def _load_modules() -> None:
 
 def _compute_jobs() -> None:
     global jobs  # pylint: disable=invalid-name
-    amount = int(jobs.value)
-    if jobs.value < 0:
+    value = jobs.value
+    amount = int(value)
+    if value < 0:
         cpu_count = os.cpu_count() or 1
-        amount = cpu_count // -jobs.value
+        amount = cpu_count // -value
         amount = max(amount, 1)
         amount = min(amount, cpu_count)
     jobs.value = amount
@@ -3632,7 +3953,7 @@ def _list_steps() -> None:
         print(f"{step.name}:")
         print(f"  priority: {step.priority}")
         print("  outputs:")
-        for output in sorted(step.output):  # pylint: disable=redefined-outer-name
+        for output in step.sorted_output:  # pylint: disable=redefined-outer-name
             properties = []
             if is_exists(output):
                 properties.append("exists")
@@ -3650,11 +3971,8 @@ def _list_steps() -> None:
 
 def _build_targets(targets: List[str]) -> None:
     Logger.trace("Targets: " + " ".join(targets))
-    if Logger.isEnabledFor(logging.DEBUG):
-        for value in Resources.available.values():
-            if value > 0:
-                Logger.debug("Available resources: " + _dict_to_str(Resources.available))
-                break
+    if Logger.isEnabledFor(logging.DEBUG) and any(value > 0 for value in Resources.available.values()):
+        Logger.debug("Available resources: " + _dict_to_str(Resources.available))
     result: Optional[BaseException] = None
     try:
         for target in targets:
@@ -3662,7 +3980,6 @@ def _build_targets(targets: List[str]) -> None:
         result = asyncio.get_event_loop().run_until_complete(Invocation.top.sync())
     except StepException as exception:  # pylint: disable=broad-except
         result = exception
-        Invocation.current = Invocation.top
 
     if result is not None and not isinstance(result, DryRunException):
         Logger.error("Fail")
@@ -3691,7 +4008,7 @@ async def reading(*names: Strings) -> AsyncGenerator:
     actions). Otherwise, this just collects the required locks. Deferring the actual locking allows us to avoid
     deadlocks.
     """
-    invocation = Invocation.current
+    invocation = Invocation.current()
     assert not invocation.has_locks
     old_required_locks = invocation.required_locks
     try:
@@ -3701,7 +4018,6 @@ async def reading(*names: Strings) -> AsyncGenerator:
                 invocation.required_locks[name] = False
         yield
     finally:
-        invocation._become_current()  # pylint: disable=protected-access
         invocation.required_locks = old_required_locks
 
 
@@ -3714,7 +4030,7 @@ async def writing(*names: Strings) -> AsyncGenerator:
     actions). Otherwise, this just collects the required locks. Deferring the actual locking allows us to avoid
     deadlocks.
     """
-    invocation = Invocation.current
+    invocation = Invocation.current()
     assert not invocation.has_locks
     old_required_locks = invocation.required_locks
     try:
@@ -3723,7 +4039,6 @@ async def writing(*names: Strings) -> AsyncGenerator:
             invocation.required_locks[name] = True
         yield
     finally:
-        invocation._become_current()  # pylint: disable=protected-access
         invocation.required_locks = old_required_locks
 
 
@@ -3735,10 +4050,9 @@ async def locks() -> AsyncGenerator:
     It is not allowed to invoke :py:func:`reading` and/or :py:func:`writing` inside the ``with`` statement, to avoid
     deadlocks. Nested ``locks`` are allowed, but the inner ones are no-ops.
     """
-    invocation = Invocation.current
+    invocation = Invocation.current()
     if invocation.has_locks:
         yield
-        invocation._become_current()  # pylint: disable=protected-access
         return
 
     try:
@@ -3749,7 +4063,6 @@ async def locks() -> AsyncGenerator:
             async with RwLocks.locks(sorted(invocation.required_locks.items())):
                 yield
     finally:
-        invocation._become_current()  # pylint: disable=protected-access
         invocation.has_locks = False
 
 
@@ -3784,7 +4097,7 @@ def outputs() -> List[str]:
 
     These contain the concrete names for pattern outputs, except for the names of dynamic outputs.
     """
-    return Invocation.current.expanded_outputs
+    return Invocation.current().expanded_outputs
 
 
 def output(index: int = 0) -> str:
@@ -3798,7 +4111,7 @@ def inputs() -> List[str]:
     """
     Return the list of required dependencies of the current step.
     """
-    return Invocation.current.required
+    return Invocation.current().required
 
 
 def input(index: int = 0) -> str:
@@ -3812,7 +4125,7 @@ async def done(awaitable: Awaitable) -> Any:
     """
     Await some non-DynaMake async function.
     """
-    return await Invocation.current.done(awaitable)
+    return await Invocation.current().done(awaitable)
 
 
 @asynccontextmanager
@@ -3820,22 +4133,15 @@ async def context(wrapped: AsyncGenerator) -> AsyncGenerator:
     """
     Await some non-DynaMake async context.
     """
-    invocation = Invocation.current
     async with wrapped:  # type: ignore
-        invocation._become_current()  # pylint: disable=protected-access
         yield ()
-    invocation._become_current()  # pylint: disable=protected-access
 
 
 def can_make(path: str) -> bool:
     """
     Test whether there are steps for creating the specified ``path``.
     """
-    for (regexp, _) in Step.by_regexp:
-        if re.fullmatch(regexp, path):
-            return True
-
-    return False
+    return Step.may_produce(path)
 
 
 def try_require(path: str) -> bool:
@@ -3862,7 +4168,7 @@ def expand(*templates: Strings, **kwargs: Strings) -> List[str]:
     def _collect(items: List[Tuple[str, Strings]]) -> None:
         if len(items) == 0:
             for template in formats:
-                results.append(template.format(**data))
+                results.append(template.format_map(data))
         else:
             name, values = items[0]
             for value in flatten(values):
@@ -9,10 +9,12 @@ import asyncio
 import os
 import sys
 from time import sleep
+from time import time_ns
 from typing import Callable
 from typing import List
 from typing import Optional
 from typing import Tuple
+from unittest.mock import patch
 
 from testfixtures import LogCapture  # type: ignore
 
@@ -20,6 +22,7 @@ from dynamake import Logger
 from dynamake import Parameter
 from dynamake import StepException
 from dynamake import above
+from dynamake import can_make
 from dynamake import done
 from dynamake import make
 from dynamake import optional
@@ -82,6 +85,31 @@ class TestMake(TestWithReset):
             _register,
         )
 
+    def test_can_make(self) -> None:
+        @step(output="foo/{*name}.txt")
+        async def make_foo() -> None:  # pylint: disable=unused-variable
+            pass
+
+        self.assertTrue(can_make("foo/bar.txt"))
+        self.assertFalse(can_make("bar/foo.txt"))
+
+        @step(output=["bar/{*name}.txt", "baz/{*name}.txt"])
+        async def make_bar(name: str) -> None:  # pylint: disable=unused-variable
+            pass
+
+        self.assertTrue(can_make("bar/foo.txt"))
+        self.assertTrue(can_make("baz/foo.txt"))
+        self.assertFalse(can_make("foo/bar.csv"))
+
+    def test_can_make_backslash_digit(self) -> None:
+        @step(output="foo/{*name:a\\1}.txt")
+        async def make_foo(name: str) -> None:  # pylint: disable=unused-variable
+            pass
+
+        self.assertTrue(can_make("foo/a\\1.txt"))
+        self.assertFalse(can_make("foo/a1.txt"))
+        self.assertFalse(can_make("foo/aa.txt"))
+
     def test_bad_resources(self) -> None:
         self.assertRaisesRegex(RuntimeError, "Unknown resource parameter: foo", resource_parameters, foo=1)
 
@@ -142,6 +170,43 @@ class TestMain(TestWithFiles):
             ],
         )
 
+    def test_require_twice(self) -> None:
+        def _register() -> None:
+            @step(output=phony("all"))
+            async def make_all() -> None:  # pylint: disable=unused-variable
+                require("foo")
+                require("foo")
+
+        write_file("foo")
+
+        sys.argv += ["--jobs", "0"]
+
+        self.check(
+            _register,
+            log=[
+                ("dynamake", "TRACE", "#0 - make - Targets: all"),
+                ("dynamake", "DEBUG", "#0 - make - Build the required: all"),
+                ("dynamake", "DEBUG", "#0 - make - The required: all will be produced by the spawned: #1 - make_all"),
+                ("dynamake", "TRACE", "#1 - make_all - Call"),
+                (
+                    "dynamake",
+                    "WHY",
+                    "#1 - make_all - Must run actions because missing the persistent actions: "
+                    ".dynamake/make_all.actions.yaml",
+                ),
+                ("dynamake", "DEBUG", "#1 - make_all - Build the required: foo"),
+                ("dynamake", "DEBUG", "#1 - make_all - The required: foo is a source file"),
+                ("dynamake", "DEBUG", "#1 - make_all - Synced"),
+                ("dynamake", "DEBUG", "#1 - make_all - Has the required: foo"),
+                ("dynamake", "DEBUG", "#1 - make_all - Write the persistent actions: .dynamake/make_all.actions.yaml"),
+                ("dynamake", "TRACE", "#1 - make_all - Complete"),
+                ("dynamake", "DEBUG", "#0 - make - Sync"),
+                ("dynamake", "DEBUG", "#0 - make - Synced"),
+                ("dynamake", "DEBUG", "#0 - make - Has the required: all"),
+                ("dynamake", "TRACE", "#0 - make - Complete"),
+            ],
+        )
+
     def test_multiple_producers(self) -> None:
         def _register() -> None:
             @step(output=phony("all"))
@@ -1352,6 +1417,69 @@ class TestMain(TestWithFiles):
             ],
         )
 
+    def _check_touched_output_is_newer(self) -> None:
+        def _register() -> None:
+            @step(output="all")
+            async def make_all() -> None:  # pylint: disable=unused-variable
+                require("foo")
+                await shell("touch all")
+
+        write_file("foo")
+        input_mtime_ns = (time_ns() // 1_000_000_000 + 10) * 1_000_000_000
+        os.utime("foo", ns=(input_mtime_ns, input_mtime_ns))
+
+        sys.argv += ["--jobs", "0"]
+        sys.argv += ["--rebuild_changed_actions", "false"]
+        sys.argv += ["--touch_success_outputs", "true"]
+
+        self.check(_register)
+
+        self.assertEqual(os.stat("foo").st_mtime_ns, input_mtime_ns)
+        self.assertGreater(os.stat("all").st_mtime_ns, input_mtime_ns)
+
+    def test_touched_output_is_newer(self) -> None:
+        self._check_touched_output_is_newer()
+
+    def test_touched_output_is_newer_with_coarse_mtimes(self) -> None:
+        real_utime = os.utime
+
+        def _coarse_utime(path: str, ns: Optional[Tuple[int, int]] = None) -> None:
+            if ns is None:
+                real_utime(path)
+            else:
+                seconds_ns = (ns[1] // 1_000_000_000) * 1_000_000_000
+                real_utime(path, ns=(seconds_ns, seconds_ns))
+
+        with patch("os.utime", _coarse_utime):
+            self._check_touched_output_is_newer()
+
+    def test_touched_output_is_not_newer(self) -> None:
+        def _register() -> None:
+            @step(output="all")
+            async def make_all() -> None:  # pylint: disable=unused-variable
+                require("foo")
+                await shell("touch all")
+
+        write_file("foo")
+        input_mtime_ns = (time_ns() // 1_000_000_000 + 10) * 1_000_000_000
+        os.utime("foo", ns=(input_mtime_ns, input_mtime_ns))
+
+        sys.argv += ["--jobs", "0"]
+        sys.argv += ["--rebuild_changed_actions", "false"]
+        sys.argv += ["--touch_success_outputs", "true"]
+
+        real_utime = os.utime
+
+        def _now_utime(path: str, ns: Optional[Tuple[int, int]] = None) -> None:  # pylint: disable=unused-argument
+            real_utime(path)
+
+        with patch("os.utime", _now_utime), patch("dynamake.Logger.warning") as warning:
+            self.check(_register)
+
+        self.assertLess(os.stat("all").st_mtime_ns, input_mtime_ns)
+        warning.assert_called_once()
+        self.assertTrue(warning.call_args[0][0].startswith("Failed to touch the output: all time: "))
+
     def test_built_dependencies(self) -> None:
         def _register() -> None:
             @step(output=phony("all"))
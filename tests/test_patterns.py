@@ -161,6 +161,14 @@ class TestConversions(TestWithReset):
             not_match=["foo12baz", "fooQbaz"],
         )
 
+    def test_unnamed_capture2re(self) -> None:
+        self.assertEqual(capture2re("foo/{**bar}/{*baz}", named=False), r"foo/(?:(?:.*)/)?(?:[^/]*)")
+
+        combined = "|".join(f"(?:{capture2re(pattern, named=False)})" for pattern in ["{*bar}.c", "{*bar}.h"])
+        self.assertTrue(re.fullmatch(combined, "foo.c"))
+        self.assertTrue(re.fullmatch(combined, "foo.h"))
+        self.assertFalse(re.fullmatch(combined, "foo.o"))
+
     def test_fmt_capture(self) -> None:
         self.assertEqual(
             fmt_capture(dict(foo="x", bar="y"), "{foo}.{*bar:[a-z]}.{*_baz}.{**_vaz:[a-z]}.{{txt}}"),
@@ -219,6 +227,7 @@ class TestConversions(TestWithReset):
     def test_capture_to_glob(self) -> None:
         self.assertEqual(capture2glob(""), "")
         self.assertEqual(capture2glob("a"), "a")
+        self.assertEqual(capture2glob("{foo}/a}"), "{foo}/a}")
         self.assertEqual(capture2glob("{{}}"), "{}")
         self.assertEqual(capture2glob("{foo}{*bar:[0-9]}baz"), "{foo}[0-9]baz")
         self.assertEqual(capture2glob("foo/{**bar}/baz"), "foo/**/baz")
@@ -2,6 +2,7 @@
 Test the stat caching.
 """
 
+import asyncio
 import os
 import shutil
 
@@ -57,6 +58,22 @@ class TestStat(TestWithFiles):
         self.assertFalse(Stat.exists("foo"))
         self.assertFalse(Stat.exists("foo/bar"))
 
+    def test_forget_many(self) -> None:
+        os.mkdir("foo")
+        write_file("foo.c")
+        write_file("foo/bar")
+        write_file("baz")
+        self.assertTrue(Stat.exists("foo/bar"))
+        self.assertTrue(Stat.exists("foo.c"))
+        self.assertTrue(Stat.exists("baz"))
+        shutil.rmtree("foo")
+        os.remove("baz")
+        Stat.forget_many(["foo", "baz"])
+        self.assertFalse(Stat.exists("foo"))
+        self.assertFalse(Stat.exists("foo/bar"))
+        self.assertFalse(Stat.exists("baz"))
+        self.assertTrue(Stat.exists("foo.c"))
+
     def test_glob(self) -> None:
         os.mkdir("foo")
         self.assertTrue(Stat.exists("foo"))
@@ -68,3 +85,37 @@ class TestStat(TestWithFiles):
         self.assertEqual(Stat.glob("foo"), [])
         self.assertFalse(Stat.exists("foo"))
         self.assertEqual(Stat.glob("foo"), [])
+
+    def test_glob_missing(self) -> None:
+        self.assertEqual(Stat.glob("foo"), [])
+        write_file("foo")
+        self.assertEqual(Stat.glob("foo"), ["foo"])
+        os.remove("foo")
+        self.assertEqual(Stat.glob("foo"), ["foo"])
+
+    def test_prefetch(self) -> None:
+        write_file("foo")
+        self.assertEqual(Stat.uncached(["foo", "bar"]), ["foo", "bar"])
+        asyncio.get_event_loop().run_until_complete(Stat.prefetch(["foo", "bar"]))
+        self.assertEqual(Stat.uncached(["foo", "bar"]), [])
+        os.remove("foo")
+        write_file("bar")
+        self.assertTrue(Stat.exists("foo"))
+        self.assertFalse(Stat.exists("bar"))
+
+    def test_touch(self) -> None:
+        write_file("foo")
+        mtime_ns = Stat.stat("foo").st_mtime_ns + 1_000_000_000
+        Stat.touch("foo", mtime_ns)
+        self.assertEqual(Stat.stat("foo").st_mtime_ns, mtime_ns)
+
+    def test_prefetch_blocking(self) -> None:
+        names = [f"foo{index}" for index in range(Stat.PREFETCH_THRESHOLD)]
+        for name in names[1:]:
+            write_file(name)
+        Stat.prefetch_blocking(names)
+        self.assertEqual(Stat.uncached(names), [])
+        write_file(names[0])
+        os.remove(names[1])
+        self.assertFalse(Stat.exists(names[0]))
+        self.assertTrue(Stat.exists(names[1]))